@@ -0,0 +1,46 @@
+def batch_sizes(batch_size, walk_length, window_size, chunk_size, chunk_negatives):
+    '''
+    Computing the number of sources and negative samples of a block of walks.
+    :param batch_size: Number of walks in the block
+    :param walk_length: Length(number of nodes) of random walker
+    :param window_size: Maximum distance between the current and predicted node in the network
+    :param chunk_size: Number of sources which share negative samples
+    :param chunk_negatives: Number of negative samples per chunk
+    '''
+    source_count = batch_size * 2 * (walk_length - window_size) * window_size
+    chunk_count = (source_count + chunk_size - 1) // chunk_size
+    return source_count, chunk_count * chunk_negatives
+
+
+def window_pairs(walks, window_size):
+    '''
+    Viewing the (walk[i], walk[i+j]) pairs of a block of walks for i in [0, L-w) and j in [1, w] without copying.
+    :param walks: (B, L) tensor of persona random walks
+    :param window_size: Maximum distance between the current and predicted node in the network
+    :return: (B, L-w, w) views of source and context nodes
+    '''
+    batch_size, walk_length = walks.size()
+    span = walk_length - window_size
+    sources = walks[:, :span].unsqueeze(2).expand(-1, -1, window_size)
+    contexts = walks.as_strided((batch_size, span, window_size),
+                                (walks.stride(0), walks.stride(1), walks.stride(1)),
+                                walks.storage_offset() + walks.stride(1))
+    return sources, contexts
+
+
+def build_batch(walks, window_size, sources, contexts):
+    '''
+    Filling the source and context nodes of a block of persona random walks into preallocated buffers.
+    Backward pairs (walk[i], walk[i-j]) are the forward pairs of the reversed walks.
+    The buffers must be sized with batch_sizes and live on the same device as the walks.
+    :param walks: (B, L) tensor of persona random walks
+    :param window_size: Maximum distance between the current and predicted node in the network
+    :param sources: Output buffer of source nodes
+    :param contexts: Output buffer of context nodes
+    '''
+    batch_size, walk_length = walks.size()
+    shape = (2, batch_size, walk_length - window_size, window_size)
+    sources, contexts = sources.view(shape), contexts.view(shape)
+    for direction, (source_view, context_view) in enumerate((window_pairs(walks, window_size), window_pairs(walks.flip(1), window_size))):
+        sources[direction].copy_(source_view)
+        contexts[direction].copy_(context_view)
@@ -0,0 +1,72 @@
+import warnings
+import argparse
+import collections
+import torch
+from splitter import SplitterTrainer
+from utils import read_graph
+
+
+def parse_args():
+    '''
+    Parses the arguments of the synchronization check.
+    '''
+    parser = argparse.ArgumentParser(description="Count host-device synchronizations of Splitter training steps")
+
+    parser.add_argument('--input', nargs='?', default='graph/karate.elist',
+                        help='Input graph path')
+
+    parser.add_argument('--warmup-steps', type=int, default=3,
+                        help='Steps run before counting, e.g. for compilation. Default is 3.')
+
+    parser.add_argument('--steps', type=int, default=10,
+                        help='Number of counted training steps. Default is 10.')
+
+    return parser.parse_args()
+
+
+def count_syncs(trainer, steps):
+    """
+    Running training steps with torch.cuda.set_sync_debug_mode("warn") and counting the warnings per call site.
+    :param trainer: SplitterTrainer after setup_training
+    :param steps: Number of training steps to run
+    :return: Counter of (file name, line number) of synchronizing calls
+    """
+    permutation = torch.randperm(len(trainer.device_walks), device=trainer.device, generator=trainer.generator)
+    blocks = torch.split(permutation, trainer.walks_per_batch)[:steps]
+    sync_sites = collections.Counter()
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        torch.cuda.set_sync_debug_mode("warn")
+        try:
+            for walk_indices in blocks:
+                trainer.train_step(walk_indices)
+        finally:
+            torch.cuda.set_sync_debug_mode("default")
+    for warning in caught:
+        if "synchronizing" in str(warning.message):
+            sync_sites[(warning.filename, warning.lineno)] += 1
+    return sync_sites, len(blocks)
+
+
+def main():
+    """
+    Setting up a Splitter on the input graph and reporting the synchronizing calls of its training steps.
+    """
+    args = parse_args()
+    if not torch.cuda.is_available():
+        raise SystemExit("Synchronization checks need a CUDA device.")
+
+    trainer = SplitterTrainer(read_graph(args.input))
+    trainer.setup_training()
+    warmup = torch.split(torch.arange(len(trainer.device_walks), device=trainer.device), trainer.walks_per_batch)[:args.warmup_steps]
+    for walk_indices in warmup:
+        trainer.train_step(walk_indices)
+    torch.cuda.synchronize()
+
+    sync_sites, steps = count_syncs(trainer, args.steps)
+    print("%d synchronizations in %d steps" % (sum(sync_sites.values()), steps))
+    for (file_name, line), count in sync_sites.most_common():
+        print("%6d  %s:%d" % (count, file_name, line))
+
+if __name__ == "__main__":
+    main()
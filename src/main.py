@@ -66,12 +66,22 @@ def parse_args():
                         type = int,
                         default = 5,
                         help = "Negative sample number. Default is 5.")
+
+    parser.add_argument("--chunk-size",
+                        type = int,
+                        default = 50,
+                        help = "Number of source nodes sharing negative samples. Default is 50.")
+
+    parser.add_argument("--chunk-negatives",
+                        type = int,
+                        default = 5,
+                        help = "Negative samples drawn per chunk. Default is 5.")
     
     ## computation configuration
     parser.add_argument("--seed",
                         type = int,
                         default = 42,
-                        help = "Random seed for PyTorch. Default is 42.")
+                        help = "Random seed for PyTorch and negative sampling. Default is 42.")
     
     parser.add_argument('--workers', type=int, default=8,
                         help='Number of parallel workers. Default is 8.')
@@ -117,7 +127,10 @@ def main():
                         learning_rate=args.learning_rate,
                         lambd=args.lambd,
                         negative_samples=args.negative_samples,
-                        workers=args.workers)
+                        chunk_size=args.chunk_size,
+                        chunk_negatives=args.chunk_negatives,
+                        workers=args.workers,
+                        seed=args.seed)
 
     splitter_trainer.fit()
     splitter_trainer.save_base_embedding(args.emb_base)
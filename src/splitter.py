@@ -4,8 +4,8 @@ import networkx as nx
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
-from walkers import Node2Vec
-from torch.utils.data import DataLoader, Dataset
+from walkers import Node2Vec, alias_setup
+from _fast_batch import batch_sizes, build_batch
 from ego_splitting import EgoNetSplitter
 import logging
 
@@ -17,13 +17,15 @@ class Splitter(torch.nn.Module):
     An implementation of "Splitter: Learning Node Representations that Capture Multiple Social Contexts" (WWW 2019).
     Paper: http://epasto.org/papers/www2019splitter.pdf
     """
-    def __init__(self, dimensions, lambd, base_node_count, node_count, device):
+    def __init__(self, dimensions, lambd, base_node_count, node_count, negative_samples, chunk_size, device):
         """
         Splitter set up.
         :param dimensions: Dimension of embedding vectors
         :param lambd: Parameter that determine how much personas spread from original embedding
         :param base_node_count: Number of nodes in the source graph.
         :param node_count: Number of nodes in the persona graph.
+        :param negative_samples: Number of negative sample per source node
+        :param chunk_size: Number of source nodes which share negative samples
         :param device: Device which torch use
         """
         super(Splitter, self).__init__()
@@ -32,14 +34,15 @@ class Splitter(torch.nn.Module):
         self.lambd = lambd
         self.base_node_count = base_node_count
         self.node_count = node_count
+        self.negative_samples = negative_samples
+        self.chunk_size = chunk_size
         self.device = device
 
     def create_weights(self):
         """
         Creating weights for embedding.
         """
-        self.base_node_embedding = torch.nn.Embedding(self.base_node_count, self.dimensions, padding_idx = 0)
-        self.node_embedding = torch.nn.Embedding(self.node_count, self.dimensions, padding_idx = 0)
+        self.node_embedding = torch.nn.Embedding(self.node_count, self.dimensions, padding_idx = 0, sparse=True)
 
     def initialize_weights(self, base_node_embedding, mapping, str2idx):
         """
@@ -49,24 +52,48 @@ class Splitter(torch.nn.Module):
         :param str2idx: Mapping string of original network to index in original network
         """
         persona_embedding = np.array([base_node_embedding[str2idx[original_node]] for node, original_node in mapping.items()])
-        self.node_embedding.weight.data = torch.nn.Parameter(torch.Tensor(persona_embedding)).to(self.device)
-        self.base_node_embedding.weight.data = torch.nn.Parameter(torch.Tensor(base_node_embedding), requires_grad=False).to(self.device)
+        self.node_embedding.weight.data = torch.Tensor(persona_embedding).to(self.device)
+        self.quantize_base_embedding(torch.Tensor(base_node_embedding).to(self.device))
 
-    def calculate_main_loss(self, node_f, feature_f, targets):
+    def quantize_base_embedding(self, base_node_embedding):
+        """
+        Storing the frozen base embedding as L2-normalized int8 rows with a float16 scale per row.
+        :param base_node_embedding: Node embedding of the source graph.
+        """
+        base_node_embedding = torch.nn.functional.normalize(base_node_embedding, p=2, dim=1)
+        scale = torch.clamp(base_node_embedding.abs().max(dim=1, keepdim=True)[0] / 127, min=1e-8)
+        self.register_buffer('base_q', torch.round(base_node_embedding / scale).to(torch.int8))
+        self.register_buffer('base_scale', scale.to(torch.float16))
+
+    def base_node_embedding(self, nodes):
+        """
+        Dequantizing the base embedding vectors of nodes.
+        :param nodes: Indices of nodes in the source graph
+        """
+        return self.base_q[nodes].float() * self.base_scale[nodes].float()
+
+    def calculate_main_loss(self, source_f, context_f, negative_f):
         """
         Calculating the main loss which is used to learning based on persona random walkers
         It will be act likes centrifugal force from the base embedding
-        :param node_f: Embedding vectors of source nodes
-        :param feature_f: Embedding vectors of target nodes to predict
-        :param targets: Boolean vector whether negative samples or not
-        """
-        node_f = torch.nn.functional.normalize(node_f, p=2, dim=1)
-        feature_f = torch.nn.functional.normalize(feature_f, p=2, dim=1)
-        scores = torch.sum(node_f*feature_f, dim=1)
-        scores = torch.sigmoid(scores)
-        main_loss = targets*torch.log(scores) + (1-targets)*torch.log(1-scores)
-        main_loss = -torch.mean(main_loss)
-        
+        Every chunk of source nodes shares the same negative samples, weighted as negative_samples draws per source
+        :param source_f: Embedding vectors of source nodes
+        :param context_f: Embedding vectors of context nodes to predict
+        :param negative_f: Embedding vectors of negative samples, one row of samples per chunk
+        """
+        source_f = torch.nn.functional.normalize(source_f, p=2, dim=1)
+        context_f = torch.nn.functional.normalize(context_f, p=2, dim=1)
+        negative_f = torch.nn.functional.normalize(negative_f, p=2, dim=2)
+        positive_scores = torch.sum(source_f*context_f, dim=1)
+
+        chunk_count, chunk_negatives = negative_f.size(0), negative_f.size(1)
+        padding = chunk_count*self.chunk_size - source_f.size(0)
+        chunked_f = torch.nn.functional.pad(source_f, (0, 0, 0, padding)).view(chunk_count, self.chunk_size, -1)
+        negative_scores = torch.bmm(chunked_f, negative_f.transpose(1, 2)).view(-1, chunk_negatives)[:source_f.size(0)].float()
+
+        main_loss = torch.nn.functional.logsigmoid(positive_scores) + self.negative_samples*torch.mean(torch.nn.functional.logsigmoid(-negative_scores), dim=1)
+        main_loss = -torch.mean(main_loss)/(self.negative_samples+1)
+
         return main_loss
 
     def calculate_regularization(self, source_f, original_f):
@@ -74,28 +101,26 @@ class Splitter(torch.nn.Module):
          Calculating the main loss which is used to learning based on persona random walkers
          It will be act likes centripetal force from the base embedding
          :param source_f: Embedding vectors of source nodes
-         :param original_f: Embedding vectors of base embedding of source nodes
+         :param original_f: L2-normalized embedding vectors of base embedding of source nodes
          """
         source_f = torch.nn.functional.normalize(source_f, p=2, dim=1)
-        original_f = torch.nn.functional.normalize(original_f, p=2, dim=1)
         scores = torch.sum(source_f*original_f,dim=1)
-        scores = torch.sigmoid(scores)
-        regularization_loss = -torch.mean(torch.log(scores))
+        regularization_loss = -torch.mean(torch.nn.functional.logsigmoid(scores))
         
         return regularization_loss
 
-    def forward(self, node_f, feature_f, targets, source_f, original_f):
+    def forward(self, source_f, context_f, negative_f, original_f):
         """
         1.main loss part
-        :param node_f: Embedding vectors of source nodes
-        :param feature_f: Embedding vectors of target nodes to predict
-        :param targets: Boolean vector whether negative samples or not
+        :param source_f: Embedding vectors of source nodes
+        :param context_f: Embedding vectors of context nodes to predict
+        :param negative_f: Embedding vectors of negative samples of each chunk
 
         2.regularization part
         :param source_f: Embedding vectors of source nodes
         :param original_f: Embedding vectors of base embedding of source nodes
         """
-        main_loss = self.calculate_main_loss(node_f, feature_f, targets)
+        main_loss = self.calculate_main_loss(source_f, context_f, negative_f)
         regularization_loss = self.calculate_regularization(source_f, original_f)
         loss = main_loss + self.lambd * regularization_loss
         
@@ -118,8 +143,11 @@ class SplitterTrainer(object):
                         learning_rate=0.01,
                         lambd = 0.1,
                         negative_samples=5,
+                        chunk_size=50,
+                        chunk_negatives=5,
 						size_of_batch=1000,
-                        workers=1):
+                        workers=1,
+                        seed=42):
         """
         :param graph: NetworkX graph object.
         :param directed: Directed network(True) or undirected network(False)
@@ -132,7 +160,10 @@ class SplitterTrainer(object):
         :param base_iter: Number of iterations (epochs) over the walks
         :param learning_rate: Learning rate of Splitter
         :param negative_samples: Number of negative sample in splitter
+        :param chunk_size: Number of source nodes which share negative samples
+        :param chunk_negatives: Number of negative samples drawn for each chunk
         :param workers: Number of CPU cores that will be used in training
+        :param seed: Random seed for negative sampling and the order of walks
         """
         self.graph = graph
         self.directed = directed
@@ -145,19 +176,28 @@ class SplitterTrainer(object):
         self.window_size = window_size
         self.base_iter = base_iter
         self.workers = workers
+        self.seed = seed
 
         self.learning_rate = learning_rate
         self.lambd = lambd
         self.negative_samples = negative_samples 
+        self.chunk_size = chunk_size
+        self.chunk_negatives = chunk_negatives
+
+        self.walks_per_batch = 100
+        self.log_interval = 10
 
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')  
 
     def create_negative_sample_pool(self):
         """
-        Creating the node pools to sample negative samples based on node degree distribution
+        Creating the alias tables to sample negative samples based on node degree distribution
         """
-        self.downsampled_degrees = {node: int(1+self.egonet_splitter.persona_graph.degree(node)**0.75) for node in self.egonet_splitter.persona_graph.nodes()}
-        self.negative_samples_pool = [k for k, v in self.downsampled_degrees.items() for i in range(v)]
+        degrees = np.diff(self.persona_csr.indptr)
+        self.downsampled_degrees = (1 + degrees**0.75).astype(np.int64)
+        alias_J, alias_q = alias_setup(self.downsampled_degrees / self.downsampled_degrees.sum())
+        self.alias_J = torch.from_numpy(alias_J).to(self.device)
+        self.alias_q = torch.from_numpy(alias_q).to(self.device)
                   
     def base_model_fit(self):
         """
@@ -192,7 +232,20 @@ class SplitterTrainer(object):
                                             q=self.q)
         logging.info("Doing persona random walks.")
         self.persona_walker.simulate_walks()
+        self.persona_walks = np.asarray(self.persona_walker.walks, dtype=np.int64)
+        del self.persona_walker.walks
+        persona_graph = self.egonet_splitter.persona_graph
+        self.persona_csr = nx.to_scipy_sparse_array(persona_graph, nodelist=range(persona_graph.number_of_nodes()), format='csr')
         self.create_negative_sample_pool()
+        self.create_personality_lut()
+
+    def create_personality_lut(self):
+        """
+        Creating the lookup table from persona nodes to indices of their original nodes
+        """
+        persona_node_count = self.egonet_splitter.persona_graph.number_of_nodes()
+        self.personality_lut = np.fromiter((self.base_walker.str2idx[self.egonet_splitter.personality_map[node]] for node in range(persona_node_count)),
+                                           dtype=np.int64, count=persona_node_count)
 
     def setup_model(self):
         """
@@ -200,79 +253,106 @@ class SplitterTrainer(object):
         """
         base_node_count = self.graph.number_of_nodes()
         persona_node_count = self.egonet_splitter.persona_graph.number_of_nodes()
-        self.model = Splitter(self.dimensions, self.lambd, base_node_count, persona_node_count, self.device)
+        self.model = Splitter(self.dimensions, self.lambd, base_node_count, persona_node_count, self.negative_samples, self.chunk_size, self.device)
         self.model.create_weights()
         self.model.initialize_weights(self.base_node_embedding, self.egonet_splitter.personality_map, self.base_walker.str2idx) 
+        self.persona_to_base_idx = torch.from_numpy(self.personality_lut).to(self.device)
+        self.setup_buffers()
 
-    def reset_node_sets(self):
+    def setup_buffers(self):
         """
-        Resetting the node sets.
+        Allocating the device buffers of a full batch once and the random generator for negative sampling.
         """
-        self.pure_sources = []
-        self.personas = []
-        self.sources = []
-        self.contexts = []
-        self.targets = []       
+        source_count, negative_count = batch_sizes(self.walks_per_batch, self.persona_walks.shape[1], self.window_size, self.chunk_size, self.chunk_negatives)
+        self.sources_buf = torch.empty(source_count, dtype=torch.long, device=self.device)
+        self.contexts_buf = torch.empty(source_count, dtype=torch.long, device=self.device)
+        self.negatives_buf = torch.empty(negative_count, dtype=torch.long, device=self.device)
+        self.generator = torch.Generator(device=self.device)
+        self.generator.manual_seed(self.seed)
 
-   
-    def create_batch_from_path(self, walk):
-        source_nodes = [walk[i] for i in range(self.walk_length-self.window_size) for j in range(1,self.window_size+1)]
-        context_nodes = [walk[i + j] for i in range(self.walk_length-self.window_size) for j in range(1,self.window_size+1)]
-        source_nodes += [walk[i] for i in range(self.window_size,self.walk_length) for j in range(1,self.window_size+1)]
-        context_nodes += [walk[i - j] for i in range(self.window_size,self.walk_length) for j in range(1,self.window_size+1)]
-        
-        length_of_source_nodes = len(source_nodes)
-        self.pure_sources += source_nodes
-        self.personas += [self.base_walker.str2idx[self.egonet_splitter.personality_map[source_node.item()]] for source_node in source_nodes]
-        self.sources += source_nodes * (self.negative_samples + 1)
-        self.contexts += context_nodes + list(np.random.choice(self.negative_samples_pool, self.negative_samples * length_of_source_nodes))
-        self.targets +=  [1.0] * length_of_source_nodes + [0.0] * (self.negative_samples * length_of_source_nodes)
+    def create_batch_from_path(self, walks):
+        """
+        Creating the sources, contexts and negative samples of a block of walks in the preallocated buffers.
+        :param walks: Block of persona random walks on the device
+        """
+        source_count, negative_count = batch_sizes(walks.size(0), walks.size(1), self.window_size, self.chunk_size, self.chunk_negatives)
+        sources = self.sources_buf[:source_count]
+        contexts = self.contexts_buf[:source_count]
+        negatives = self.negatives_buf[:negative_count]
+        build_batch(walks, self.window_size, sources, contexts)
+        self.sample_negatives(negatives)
+        return sources, contexts, negatives
+
+    def sample_negatives(self, negatives):
+        """
+        Drawing negative samples from the alias tables.
+        :param negatives: Output buffer of negative samples
+        """
+        candidates = torch.randint(len(self.alias_J), negatives.size(), device=self.device, generator=self.generator)
+        accepted = torch.rand(negatives.size(), device=self.device, generator=self.generator) < self.alias_q[candidates]
+        torch.where(accepted, candidates, self.alias_J[candidates], out=negatives)
 
-    def transfer_batch(self):
+    def transfer_batch(self, batch):
         """
-        Transfering the batch to GPU.
+        Looking up the embeddings of a batch.
+        :param batch: Sources, contexts and negatives of the batch
         """
-        self.node_f = self.model.node_embedding(torch.LongTensor(self.sources).to(self.device))
-        self.feature_f = self.model.node_embedding(torch.LongTensor(self.contexts).to(self.device))
-        self.targets = torch.FloatTensor(self.targets).to(self.device)
-        self.source_f = self.model.node_embedding(torch.LongTensor(self.pure_sources).to(self.device))
-        self.original_f = self.model.base_node_embedding(torch.LongTensor(self.personas).to(self.device))
+        sources, contexts, negatives = batch
+        features = self.model.node_embedding(torch.cat([sources, contexts, negatives]))
+        self.source_f, self.context_f, negative_f = torch.split(features, [len(sources), len(contexts), len(negatives)])
+        self.negative_f = negative_f.view(-1, self.chunk_negatives, self.dimensions)
+        self.original_f = self.model.base_node_embedding(self.persona_to_base_idx.index_select(0, sources))
 
     def optimize(self):
         """
         Doing a weight update.
+        The loss is computed in bfloat16 autocast on GPU.
         """
-        loss = self.model(self.node_f, self.feature_f, self.targets, self.source_f, self.original_f)
+        with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.device.type == 'cuda'):
+            loss = self.model(self.source_f, self.context_f, self.negative_f, self.original_f)
         loss.backward()
         self.optimizer.step()
         self.optimizer.zero_grad()
-        self.reset_node_sets()
-        return loss.item()  
+        return loss.detach()
 
-    def fit(self):
+    def setup_training(self):
         """
-        Fitting a model.
+        Preparing the model, the optimizer and the device-resident walks for training.
         """
-        self.reset_node_sets()
         self.base_model_fit()
         self.create_split()
         self.setup_model()
         self.model.train()
-        self.optimizer = torch.optim.Adam(self.model.parameters(), lr=self.learning_rate)
+        if self.device.type == 'cuda':
+            self.model = torch.compile(self.model, dynamic=False)
+        self.optimizer = torch.optim.SparseAdam(self.model.parameters(), lr=self.learning_rate)
         self.optimizer.zero_grad()
-        dataset = MyDataset(np.array(self.persona_walker.walks))
-        dataloader = DataLoader(dataset, batch_size=100, pin_memory=False, shuffle=True, num_workers=1)
+        self.device_walks = torch.from_numpy(self.persona_walks).to(self.device)
+
+    def train_step(self, walk_indices):
+        """
+        Doing a weight update on a block of walks.
+        :param walk_indices: Indices of the walks in the block
+        """
+        self.transfer_batch(self.create_batch_from_path(self.device_walks[walk_indices]))
+        return self.optimize()
 
-        data_iterator = tqdm(dataloader,
+    def fit(self):
+        """
+        Fitting a model.
+        """
+        self.setup_training()
+        permutation = torch.randperm(len(self.device_walks), device=self.device, generator=self.generator)
+
+        data_iterator = tqdm(torch.split(permutation, self.walks_per_batch),
 							leave=True,
 							unit='batch',
                             postfix={'lss':'% 6f' % 0.0})
-        for i, walks in enumerate(data_iterator):
-            for walk in walks:
-                self.create_batch_from_path(walk)
-            self.transfer_batch()
-            self.losses = self.optimize()
-            data_iterator.set_postfix(lss='%.6f' % self.losses)
+        for i, walk_indices in enumerate(data_iterator):
+            loss = self.train_step(walk_indices)
+            if i % self.log_interval == 0:
+                self.losses = loss.item()
+                data_iterator.set_postfix(lss='%.6f' % self.losses)
 			
 			
                 
@@ -291,9 +371,8 @@ class SplitterTrainer(object):
         logging.info("Saving the model.")
         nodes = [node for node in self.egonet_splitter.persona_graph.nodes()]
         nodes.sort()
-        nodes = torch.LongTensor(nodes).to(self.device)
-        self.embedding = self.model.node_embedding(nodes).cpu().detach().numpy()
-        return_data = {str(node.item()): embedding for node, embedding in zip(nodes, self.embedding)}
+        self.embedding = self.model.node_embedding(torch.LongTensor(nodes).to(self.device)).cpu().detach().numpy()
+        return_data = {str(node): embedding for node, embedding in zip(nodes, self.embedding)}
         pd.to_pickle(return_data, file_name)
                 
     def save_persona_graph_mapping(self, file_name):
@@ -308,15 +387,3 @@ class SplitterTrainer(object):
         Saving the persona graph.
         """
         nx.write_edgelist(self.egonet_splitter.persona_graph, file_name)
-
-        
-class MyDataset(Dataset):
-    def __init__(self, data):
-        self.data = data
-        
-    def __getitem__(self, index):
-        x = self.data[index]
-        return x
-    
-    def __len__(self):
-        return len(self.data)